@@ -24,13 +24,24 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #
 
+import array
+import atexit
+import collections
 import datetime
+import heapq
+import io
 import json
+import math
 import os
+import queue
 import re
+import select
 import socket
+import socketserver
+import struct
 import subprocess
 import sys
+import threading
 import time
 
 DEBUG = 3
@@ -48,23 +59,402 @@ def log(msg, level=INFO):
         print("%s:\t%s" % (_LEVELS[level], msg))
 
 
+class Span():
+
+    def __init__(self, profiler, name):
+
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+
+        self._depth = self._profiler._push()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._profiler._pop(self._name, self._start, time.time(), self._depth)
+
+
+class NoSpan():
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        pass
+
+
+class Profiler():
+
+    _BAR_WIDTH = 30
+
+    def __init__(self):
+
+        self._enabled = False
+        self._started = time.time()
+        self._spans = list()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._no_span = NoSpan()
+        self._trace_file = None
+
+    def enable(self, trace_file=None):
+
+        self._enabled = True
+        self._trace_file = trace_file
+        atexit.register(self.report)
+
+    def span(self, name):
+
+        return Span(self, name) if self._enabled else self._no_span
+
+    def _push(self):
+
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        return depth
+
+    def _pop(self, name, start, end, depth):
+
+        self._local.depth = depth
+        with self._lock:
+            self._spans.append(
+                (name, start, end, depth + 1, threading.get_ident()))
+
+    def get_spans(self):
+
+        with self._lock:
+            spans = list(self._spans)
+
+        # whole run as root of all threads
+        spans.append(("as111.py", self._started, time.time(), 0, 0))
+        return sorted(spans, key=lambda s: (s[1], s[3]))
+
+    def print_report(self):
+
+        spans = self.get_spans()
+        # bars are scaled to the whole run, i.e. the latest end of all spans
+        total = max(max(s[2] for s in spans) - self._started, 1e-6)
+
+        print("\n   total ms     self ms  phase")
+        for i, (name, start, end, depth, tid) in enumerate(spans):
+
+            children = sum(c[2] - c[1] for c in spans if c[3] == depth + 1 and (
+                c[4] == tid or depth == 0) and c[1] >= start and c[2] <= end)
+            duration = end - start
+            bar = "#" * int(round(self._BAR_WIDTH * duration / total))
+
+            print("%11.1f %11.1f  %s%s %s" % (duration * 1000, max(0, duration - children) * 1000,
+                                              "  " * depth, name, bar))
+
+    def write_trace(self, filename):
+
+        events = [{
+            "name": name,
+            "cat": "as111",
+            "ph": "X",
+            "ts": int((start - self._started) * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": os.getpid(),
+            "tid": tid
+        } for name, start, end, depth, tid in self.get_spans()]
+
+        with open(filename, "w") as out:
+            json.dump({"traceEvents": events,
+                       "displayTimeUnit": "ms"}, out)
+
+        log("trace written to %s" % filename, INFO)
+
+    def report(self):
+
+        if not self._enabled:
+            return
+
+        self.print_report()
+        if self._trace_file:
+            try:
+                self.write_trace(self._trace_file)
+            except:
+                log("unable to write trace to %s" % self._trace_file, ERROR)
+
+
+profiler = Profiler()
+
+
+def split_frames(buf):
+
+    # frames are 153 <length> <sequence no> <command> ... <checksum>
+    # where <length> counts the bytes following the length byte
+    frames = list()
+    while len(buf) > 0:
+
+        if buf[0] != 153:
+            buf = buf[1:]
+            continue
+
+        if len(buf) < 2 or len(buf) < buf[1] + 2:
+            break
+
+        frames.append(buf[:buf[1] + 2])
+        buf = buf[buf[1] + 2:]
+
+    return frames, buf
+
+
+class PacketCapture():
+
+    OUT = 0
+    IN = 1
+
+    _MAGIC = b"AS1C"
+    _VERSION = 1
+    _RECORD = struct.Struct("<dBH")
+
+    def __init__(self, size=1024):
+
+        self._frames = collections.deque(maxlen=size)
+
+    def record(self, direction, data):
+
+        self._frames.append((time.time(), direction, bytes(data)))
+
+    def get_frames(self):
+
+        return list(self._frames)
+
+    def dump(self, filename):
+
+        with open(filename, "wb") as out:
+            out.write(self._MAGIC + bytes([self._VERSION]))
+            for ts, direction, data in list(self._frames):
+                out.write(self._RECORD.pack(ts, direction, len(data)))
+                out.write(data)
+
+    @staticmethod
+    def load(filename):
+
+        frames = list()
+        with open(filename, "rb") as ins:
+            raw = ins.read()
+
+        if raw[:4] != PacketCapture._MAGIC or raw[4] != PacketCapture._VERSION:
+            raise ValueError("%s is not an as111 capture file" % filename)
+
+        i = 5
+        while i + PacketCapture._RECORD.size <= len(raw):
+            ts, direction, length = PacketCapture._RECORD.unpack_from(raw, i)
+            i += PacketCapture._RECORD.size
+            frames.append((ts, direction, raw[i:i + length]))
+            i += length
+
+        return frames
+
+
+class DockEmulator():
+
+    def __init__(self, name="AS111", version="022.10a.", volume=12, capabilities=[0, 0, 0, 0, 0, 32, 129, 255]):
+
+        self.name = name
+        self.version = version
+        self.volume = volume
+        self.capabilities = capabilities
+        self.datetime = [0] * 7
+        self.alarm_led = 0
+
+    def _get_response(self, seq, command, payload=[]):
+
+        checksum = seq + command + sum(payload)
+        return [153, 3 + len(payload), seq, command] + payload + [(-1 * checksum) & 255]
+
+    def handle(self, frame):
+
+        seq, command, payload = frame[2], frame[3], list(frame[4:-1])
+
+        if command == 8:
+            return self._get_response(seq, 9, [ord(c) for c in self.name])
+
+        elif command == 19:
+            version = [ord(c) for c in self.version]
+            return self._get_response(seq, 20, version + [0] * (12 - len(version)))
+
+        elif command == 15:
+            return self._get_response(seq, 16, [0, self.volume])
+
+        elif command == 6:
+            return self._get_response(seq, 7, list(self.capabilities))
+
+        elif command == 17 and len(payload) >= 2:
+            if payload[0] == 0:
+                self.volume = payload[1]
+            elif payload[0] == 8:
+                self.datetime = payload[1:8]
+            elif payload[0] == 24:
+                self.alarm_led = payload[1]
+            return self._get_response(seq, 4, [0])
+
+        return self._get_response(seq, 4, [1])
+
+
+class EmulatorServer(threading.Thread):
+
+    def __init__(self, emulator, port=0, delay=0):
+
+        threading.Thread.__init__(self, daemon=True)
+        self.emulator = emulator
+        self._delay = delay
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", port))
+        self._server.listen(8)
+        self._lock = threading.Lock()
+        self._connections = list()
+
+    def get_address(self):
+
+        return "tcp://127.0.0.1:%i" % self._server.getsockname()[1]
+
+    def run(self):
+
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except:
+                return
+
+            threading.Thread(target=self._serve, args=(
+                conn,), daemon=True).start()
+
+    def _serve(self, conn):
+
+        with self._lock:
+            self._connections.append(conn)
+
+        try:
+            self._handle(conn)
+        except:
+            pass
+
+        with self._lock:
+            self._connections.remove(conn)
+        conn.close()
+
+    def _handle(self, conn):
+
+        buf = []
+        while True:
+            data = conn.recv(255)
+            if not data:
+                return
+
+            frames, buf = split_frames(buf + list(data))
+            for frame in frames:
+                if self._delay:
+                    time.sleep(self._delay)
+
+                with self._lock:
+                    response = self.emulator.handle(frame)
+
+                conn.sendall(bytes(response))
+
+    def stop(self):
+
+        self._server.close()
+        with self._lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except:
+                    pass
+
+
+class FrameReader(threading.Thread):
+
+    def __init__(self, read, on_event):
+
+        threading.Thread.__init__(self, daemon=True)
+        self._read = read
+        self._on_event = on_event
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._stopped = threading.Event()
+
+    def run(self):
+
+        buf = []
+        while not self._stopped.is_set():
+
+            try:
+                buf += list(self._read())
+            except:
+                log("reading from dock failed", ERROR)
+                break
+
+            frames, buf = split_frames(buf)
+            for frame in frames:
+                self._dispatch(frame)
+
+        # wake up everybody who is still waiting for a reply
+        with self._lock:
+            for seq in self._pending:
+                self._pending[seq][0].set()
+
+    def _dispatch(self, frame):
+
+        with self._lock:
+            slot = self._pending.get(frame[2], None)
+            if slot and not slot[0].is_set():
+                slot[1] = frame
+                slot[0].set()
+                return
+
+        self._on_event(frame)
+
+    def expect(self, seq):
+
+        with self._lock:
+            self._pending[seq] = [threading.Event(), []]
+
+    def wait(self, seq, timeout):
+
+        slot = self._pending[seq]
+        slot[0].wait(timeout)
+
+        with self._lock:
+            del self._pending[seq]
+
+        return slot[1]
+
+    def stop(self):
+
+        self._stopped.set()
+
+
 class AS111():
 
     _MAC_PATTERN = "00:1D:DF:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}"
 
     _KNOWNDOCKS_FILE = ".known_as111"
+    _INVENTORY_FILE = ".as111_inventory"
+    _INVENTORY_TTL = 60
+    _CAPTURE_MAX_FILES = 10
+
+    _DEVICES_TTL = 10
+    _DEVICES_RETRY = 1
     _STOP_SIGNAL_FILE = ".as111_stop"
 
     _PORT_BLUETOOTH = "Bluetooth"
     _PORT_SERIAL = "Serial"
 
-    _verbose = 0
-    _client_socket = None
-    _serial = None
-    _sequence = 0
-    _device = None
-    _devices = list()
-    _aliases = dict()
+    _RAMP_EXP_K = 4.0
+    _RAMP_FINE_TICK = .05
+
+    _SYNC_SAMPLES = 5
+    _SYNC_MIN_LEAD = .1
+    _SYNC_SPIN = .005
 
     _capabilities = ["0-VOLUME", "1-DSC", "2-DBB", "3-TREBLE", "4-BASS",
                      "5-FULL", "6-CHARGING", "7-BATTERY", "8-DATETIME",
@@ -77,37 +467,127 @@ class AS111():
                      "24-DOCK_ALARM_LED", "25-AUDIO_SOURCE", "26-APPALM",
                      "27-RCAPPSC"]
 
-    def __init__(self):
+    def __init__(self, rescan=False, devices=None):
+
+        # state of the connection, every instance talks to one dock
+        self._client_socket = None
+        self._serial = None
+        self._sequence = 0
+        self._device = None
+        self._reader = None
+        self._received = list()
+        self._event_listeners = list()
+        self._capture = PacketCapture()
+        self._link_failed = False
+        self._synced_precisely = False
+        self._lock = threading.RLock()
+
+        # a given list of devices, e.g. emulated docks, is never refreshed
+        self._devices_updated = None
+        if devices != None:
+            self._devices = [dict(d) for d in devices]
+            self._apply_aliases()
+
+        else:
+            self.refresh_devices(rescan)
+
+    def refresh_devices(self, rescan=False):
 
         if self._is_windows():
-            self._devices = self._get_devices_for_windows()
+            with profiler.span("list serial ports"):
+                self._devices = self._get_devices_for_windows()
 
         else:
-            self._devices = self._get_devices_for_linux()
-            self._request_a2dp_state()
+            with profiler.span("discover devices"):
+                self._devices = self._get_devices_for_linux(rescan)
+
+            with profiler.span("pacmd list-sinks"):
+                self._request_a2dp_state()
+
+        self._apply_aliases()
+        self._devices_updated = time.time()
+
+    def refresh_devices_if_outdated(self):
+
+        if self._devices_updated == None:
+            return
+
+        # docks may have connected since the list has been read
+        age = time.time() - self._devices_updated
+        if age > self._DEVICES_TTL or (age > self._DEVICES_RETRY and not self.get_connected_devices()):
+            log("refresh list of devices", DEBUG)
+            self.refresh_devices()
+
+    def _apply_aliases(self):
 
         self._aliases = self._read_aliases()
         for _d in self._devices:
             if _d["address"] in self._aliases:
                 _d["alias"] = self._aliases[_d["address"]]
 
-    def _get_devices_for_linux(self):
+    @staticmethod
+    def _new_device(port, address, mac, controller, name, connected, a2dp="n/a"):
+
+        return {
+            "port": port,
+            "address": address,
+            "mac": mac,
+            "controller": controller,
+            "name": name,
+            "connected": connected,
+            "alias": "",
+            "version": "",
+            "capabilities": [],
+            "datetime": "",
+            "volume": 0,
+            "sink": "n/a",
+            "sink_volume": 0,
+            "a2dp": a2dp,
+            "codec": "n/a"
+        }
+
+    def _exec_bluetoothctl(self, commands=[]):
+
+        command_str = "\n".join(commands)
+
+        p1 = subprocess.Popen(["echo", "-e", "%s\nquit\n\n" % command_str],
+                              stdout=subprocess.PIPE)
+        p2 = subprocess.Popen(["bluetoothctl"],
+                              stdin=p1.stdout,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        p1.stdout.close()
+        out, err = p2.communicate()
+        return out.decode("utf8")
+
+    def _get_devices_for_linux(self, rescan=False):
+
+        inventory = None if rescan else self._read_inventory()
+        if inventory:
+            log("use cached inventory", DEBUG)
+            _devices = [self._new_device(self._PORT_BLUETOOTH, d["mac"], d["mac"], d["controller"], d["name"], d["connected"]) for d in inventory["devices"]]
+
+            if inventory["monitored"]:
+                return _devices
 
-        def _exec_bluetoothctl(commands=[]):
+            # without monitor the connection state may have changed meanwhile
+            if any(d["connected"] for d in _devices):
+                self._request_connected(_devices)
+                self._write_inventory(inventory["controllers"], _devices)
+                return _devices
+
+            log("no connected device in cached inventory", DEBUG)
+
+        controllers, _devices = self._scan_devices()
+        self._write_inventory(controllers, _devices)
+
+        return _devices
 
-            command_str = "\n".join(commands)
+    def _scan_devices(self):
 
-            p1 = subprocess.Popen(["echo", "-e", "%s\nquit\n\n" % command_str],
-                                  stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(["bluetoothctl"],
-                                  stdin=p1.stdout,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-            p1.stdout.close()
-            out, err = p2.communicate()
-            return out.decode("utf8")
+        log("scan for controllers and devices", DEBUG)
 
-        output = _exec_bluetoothctl()
+        output = self._exec_bluetoothctl()
 
         controllers = list()
         for match in re.finditer("Controller ([0-9A-F:]+) (.+)", output):
@@ -116,33 +596,162 @@ class AS111():
         _devices = list()
         for controller in controllers:
             time.sleep(.25)
-            output = _exec_bluetoothctl(["select %s" % controller, "devices"])
+            output = self._exec_bluetoothctl(
+                ["select %s" % controller, "devices"])
             for match in re.finditer("Device (%s) (.+)" % self._MAC_PATTERN, output):
-                _devices.append({
-                    "port": self._PORT_BLUETOOTH,
-                    "address": match.group(1),
-                    "mac": match.group(1),
-                    "controller": controller,
-                    "name": match.group(2),
-                    "connected": False,
-                    "alias": "",
-                    "version": "",
-                    "capabilities": [],
-                    "datetime": "",
-                    "volume": 0,
-                    "sink": "n/a",
-                    "a2dp": "n/a",
-                    "codec": "n/a"
-                })
+                _devices.append(self._new_device(self._PORT_BLUETOOTH, match.group(
+                    1), match.group(1), controller, match.group(2), False))
+
+        self._request_connected(_devices)
+
+        return controllers, _devices
+
+    def _request_connected(self, _devices):
 
         for _device in _devices:
-            output = _exec_bluetoothctl(
+            output = self._exec_bluetoothctl(
                 ["select %s" % _device["controller"], "info %s" % _device["mac"]])
-            for match in re.finditer("Connected: (yes|no)", output):
-                if match.group(1) == "yes":
-                    _device["connected"] = True
+            _device["connected"] = "Connected: yes" in output
 
-        return _devices
+    def _inventory_file_path(self):
+
+        return os.path.join(os.environ['HOME'] if "HOME" in os.environ else "~", self._INVENTORY_FILE)
+
+    def _read_inventory(self):
+
+        try:
+            with open(self._inventory_file_path(), "r") as ins:
+                inventory = json.load(ins)
+
+        except:
+            return None
+
+        # the cache is fresh as long as a monitor keeps it up-to-date
+        inventory["monitored"] = False
+        if inventory.get("monitor"):
+            try:
+                os.kill(inventory["monitor"], 0)
+                inventory["monitored"] = True
+                return inventory
+            except:
+                pass
+
+        if time.time() - inventory.get("updated", 0) > self._INVENTORY_TTL:
+            log("cached inventory is stale", DEBUG)
+            return None
+
+        return inventory
+
+    def _write_inventory(self, controllers, _devices, monitor=None):
+
+        inventory = {
+            "updated": time.time(),
+            "monitor": monitor,
+            "controllers": controllers,
+            "devices": [{
+                "mac": d["mac"],
+                "controller": d["controller"],
+                "name": d["name"],
+                "connected": d["connected"]
+            } for d in _devices]
+        }
+
+        try:
+            filename = self._inventory_file_path()
+            with open(filename + ".tmp", "w") as out:
+                json.dump(inventory, out, indent=2)
+            os.replace(filename + ".tmp", filename)
+
+        except:
+            log("unable to write inventory", WARN)
+
+    def monitor_inventory(self):
+
+        controllers, self._devices = self._scan_devices()
+        self._write_inventory(controllers, self._devices, os.getpid())
+
+        log("Monitor bluetooth devices", INFO)
+
+        p = subprocess.Popen(["bluetoothctl"],
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+
+        event_pattern = re.compile(
+            "\\[(NEW|DEL|CHG)\\] (Device|Controller) ([0-9A-F:]{17}) (.*)")
+        ansi_pattern = re.compile("\x1b\\[[0-9;]*m|\x01|\x02")
+
+        # read from fd directly since select() does not see buffered lines
+        fd = p.stdout.fileno()
+        lines = list()
+        buf = b""
+
+        try:
+            while not self.is_stop_signal() and p.poll() is None:
+
+                if not lines:
+                    ready, _, _ = select.select([fd], [], [], 1)
+                    if not ready:
+                        continue
+
+                    data = os.read(fd, 4096)
+                    if not data:
+                        break
+
+                    lines = (buf + data).split(b"\n")
+                    buf = lines.pop()
+                    continue
+
+                line = ansi_pattern.sub(
+                    "", lines.pop(0).decode("utf8", errors="replace"))
+                match = event_pattern.search(line)
+                if not match:
+                    continue
+
+                event, kind, mac, info = match.groups()
+                _device = next(
+                    filter(lambda d: d["mac"] == mac, self._devices), None)
+
+                if kind == "Controller":
+                    if event == "NEW" and mac not in controllers:
+                        controllers.append(mac)
+                    elif event == "DEL" and mac in controllers:
+                        controllers.remove(mac)
+                        self._devices = [
+                            d for d in self._devices if d["controller"] != mac]
+                    else:
+                        continue
+
+                elif not re.match(self._MAC_PATTERN, mac):
+                    continue
+
+                elif event == "NEW" and not _device:
+                    self._devices.append(self._new_device(
+                        self._PORT_BLUETOOTH, mac, mac, controllers[0] if controllers else "", info.strip(), False))
+
+                elif event == "DEL" and _device:
+                    self._devices.remove(_device)
+
+                elif event == "CHG" and _device and info.startswith("Connected: "):
+                    _device["connected"] = info.strip().endswith("yes")
+
+                elif event == "CHG" and _device and info.startswith("Name: "):
+                    _device["name"] = info[6:].strip()
+
+                elif event == "CHG" and _device and info.strip() == "Paired: no":
+                    self._devices.remove(_device)
+
+                else:
+                    continue
+
+                log("%s %s %s" % (event, mac, info.strip()), INFO)
+                self._write_inventory(controllers, self._devices, os.getpid())
+
+        except:
+            log("monitoring interrupted", WARN)
+
+        p.terminate()
+        self._write_inventory(controllers, self._devices)
 
     def _get_devices_for_windows(self):
 
@@ -153,22 +762,9 @@ class AS111():
                 _mac = "".join(["%s%s" % (s, ":" if i % 2 else "") for i, s in enumerate(
                     p.hwid.split("\\")[-1].split("&")[-1][:12])])[:-1]
                 if re.match(self._MAC_PATTERN, _mac):
-                    _devices.append({
-                        "port": self._PORT_SERIAL,
-                        "address": _mac if "BTPROTO_RFCOMM" in dir(socket) else p.device,
-                        "mac": _mac,
-                        "controller": "",
-                        "name": p.description,
-                        "connected": True,  # actually it maybe it's not connected
-                        "alias": "",
-                        "version": "",
-                        "capabilities": [],
-                        "datetime": "",
-                        "volume": 0,
-                        "sink": "n/a",
-                        "a2dp": "RUNNING",
-                        "codec": "n/a"
-                    })
+                    # actually it maybe it's not connected
+                    _devices.append(self._new_device(self._PORT_SERIAL, _mac if "BTPROTO_RFCOMM" in dir(
+                        socket) else p.device, _mac, "", p.description, True, "RUNNING"))
 
         return _devices
 
@@ -206,7 +802,7 @@ class AS111():
             if s == _m or s in aliases[_m]:
                 return _m, aliases[_m]
 
-        if re.match(self._MAC_PATTERN, s) or s.startswith("COM"):
+        if re.match(self._MAC_PATTERN, s) or s.startswith("COM") or s.startswith("tcp://"):
             return s, None
         else:
             return None, None
@@ -215,6 +811,10 @@ class AS111():
 
         return self._devices
 
+    def session(self, address):
+
+        return AS111Session(address, self._devices)
+
     def get_connected_devices(self):
 
         return list(filter(lambda d: d["connected"], self._devices))
@@ -234,10 +834,11 @@ class AS111():
             l = l.strip()
             if "name: <bluez_sink." in l:
                 m = re.match(sink_name_pattern, l)
-                _mac = m.groups()[0].replace("_", ":")
+                _mac = m.groups()[0].replace("_", ":") if m else None
                 _device = next(
                     filter(lambda d: d["mac"] == _mac, self._devices), None)
-                _device["sink"] = l[7:-1]
+                if _device:
+                    _device["sink"] = l[7:-1]
 
             elif "name: <" in l:
                 _device = None
@@ -245,9 +846,19 @@ class AS111():
             elif _device and "state: " in l:
                 _device["a2dp"] = l[7:]
 
+            elif _device and l.startswith("volume: "):
+                m = re.search("front-left: ([0-9]+)", l)
+                if m:
+                    _device["sink_volume"] = int(m.group(1))
+
             elif _device and "bluetooth.codec" in l:
                 _device["codec"] = l[19:-1]
 
+    def request_sink_volumes(self):
+
+        self._request_a2dp_state()
+        return {d["address"]: d["sink_volume"] for d in self._devices if d["sink"] != "n/a"}
+
     def get_running_sink(self):
 
         return next(filter(lambda d: d["a2dp"] == "RUNNING", self._devices), None)
@@ -262,6 +873,33 @@ class AS111():
 
     def connect(self, address):
 
+        with profiler.span("open link"):
+            opened = self._open_link(address)
+
+        if not opened:
+            return None
+
+        _device = next(
+            filter(lambda d: d["address"] == address, self._devices), None)
+        if not _device:
+            _device = self._new_device(self._PORT_SERIAL if address.startswith(
+                "COM") else self._PORT_BLUETOOTH, address, address, "", "", True)
+            self._devices.append(_device)
+
+        self.set_current_device(_device)
+
+        log("Connnected to %s" % address, DEBUG)
+
+        with profiler.span("sync_time"):
+            self.sync_time()
+
+        with profiler.span("request_device_info"):
+            self.request_device_info()
+
+        return True
+
+    def _open_link(self, address):
+
         try:
             if re.match(self._MAC_PATTERN, address):
                 log("Connnect via Bluetooth to %s" % address, DEBUG)
@@ -278,33 +916,38 @@ class AS111():
                 log("Connnect via serial port to %s" % address, DEBUG)
                 self._serial = serial.Serial(address, timeout=.1)
 
+            elif address.startswith("tcp://"):
+                log("Connnect via TCP to %s" % address, DEBUG)
+                host, port = address[6:].rsplit(":", 1)
+                self._client_socket = socket.create_connection(
+                    (host, int(port)), timeout=2)
+
         except:
             log(
                 "Connection failed! Check mac address and device.\n", ERROR)
 
-            return None
-
-        self.set_current_device(
-            next(filter(lambda d: d["address"] == address, self._devices), None))
-
-        log("Connnected to %s" % _device["address"], DEBUG)
-        self.sync_time()
-        self.request_device_info()
+            return False
 
         return True
 
     def disconnect(self):
 
         log("disconnect", DEBUG)
-        try:
-            if self._client_socket:
-                self._client_socket.close()
+        self.stop_reader()
+        with self._lock:
+            try:
+                if self._client_socket:
+                    self._client_socket.close()
 
-            if self._serial:
-                self._serial.close()
+                if self._serial:
+                    self._serial.close()
 
-        except:
-            pass
+            except:
+                pass
+
+            self._client_socket = None
+            self._serial = None
+            self._received = list()
 
         self.set_current_device(None)
 
@@ -341,6 +984,19 @@ class AS111():
 
         self._pacmd(["set-default-sink", self.get_current_device()["sink"]])
 
+    def _has_sink_volume(self):
+
+        if self._is_windows():
+            return False
+
+        device = self.get_current_device()
+        return device["sink"] != "n/a" and device["sink_volume"] > 0
+
+    def _set_sink_volume(self, value):
+
+        self._pacmd(["set-sink-volume", self.get_current_device()["sink"],
+                     "%i" % max(0, int(value))])
+
     def _handle_codecs(self, commands):
 
         if self._is_windows():
@@ -363,9 +1019,10 @@ class AS111():
     def _get_request(self, command, payload=[]):
 
         length = 3 + len(payload)
-        self._sequence += 1
-        self._sequence &= 255
-        request = [153, length, self._sequence, command]
+        with self._lock:
+            self._sequence += 1
+            self._sequence &= 255
+            request = [153, length, self._sequence, command]
 
         checksum = command
         for p in payload:
@@ -376,40 +1033,213 @@ class AS111():
 
         return request
 
-    def _send(self, data, lresponse=32):
+    def _read_link(self, size=0):
 
-        try:
-            log(">>> %s" % (" ".join(str(i) for i in data)), DEBUG)
+        if self._serial:
+            data = self._serial.read(size or self._serial.in_waiting or 1)
 
-            raw = []
-            if self._serial:
-                self._serial.write(data)
-                self._serial.flush()
-                raw = list(self._serial.read(lresponse))
+        else:
+            try:
+                data = self._client_socket.recv(size or 255)
+            except socket.timeout:
+                return b""
 
-                if lresponse != len(raw):
-                    log("Length of response is %i but expected %i" %
-                        (len(raw), lresponse), WARN)
+            if not data:
+                raise IOError("connection closed by dock")
 
-            elif self._client_socket:
-                self._client_socket.send(bytes(data))
-                raw = list(self._client_socket.recv(255))
+        if self._capture and data:
+            self._capture.record(PacketCapture.IN, data)
 
-        except:
-            log("request failed", ERROR)
+        return data
 
-        log("<<< %s (%i bytes)" % (" ".join(str(i)
-            for i in raw), len(raw)), DEBUG)
-        return raw
+    def _write_link(self, data):
 
-    def _get_timestamp_as_array(self):
+        if self._capture:
+            self._capture.record(PacketCapture.OUT, data)
 
-        dt_now = datetime.datetime.now()
+        if self._serial:
+            self._serial.write(data)
+            self._serial.flush()
 
-        cc = dt_now.year // 100
-        yy = dt_now.year % 100
-        mm = dt_now.month - 1
-        dd = dt_now.day
+        elif self._client_socket:
+            self._client_socket.send(bytes(data))
+
+    def _capture_dir_n_prefix(self):
+
+        name = re.sub("[^0-9A-Za-z]", "", self._device["mac"]) if self._device else "as111"
+        return os.environ["TEMP"] if self._is_windows() else "/tmp", "as111_%s_" % name
+
+    def _capture_file_path(self):
+
+        directory, prefix = self._capture_dir_n_prefix()
+        return os.path.join(directory, "%s%i.cap" % (prefix, time.time()))
+
+    def _remove_old_captures(self):
+
+        directory, prefix = self._capture_dir_n_prefix()
+        try:
+            filenames = sorted(f for f in os.listdir(directory)
+                               if f.startswith(prefix) and f.endswith(".cap"))
+            for f in filenames[:-self._CAPTURE_MAX_FILES]:
+                os.remove(os.path.join(directory, f))
+
+        except:
+            log("unable to remove old captures", WARN)
+
+    def is_link_failed(self):
+
+        return self._link_failed
+
+    def dump_capture(self, filename=None):
+
+        if not self._capture:
+            return None
+
+        default = not filename
+        filename = filename or self._capture_file_path()
+        try:
+            self._capture.dump(filename)
+            log("capture written to %s" % filename, INFO)
+        except:
+            log("unable to write capture to %s" % filename, ERROR)
+            return None
+
+        if default:
+            self._remove_old_captures()
+
+        return filename
+
+    def add_event_listener(self, callback):
+
+        self._event_listeners = self._event_listeners + [callback]
+
+    def remove_event_listener(self, callback):
+
+        self._event_listeners = [
+            l for l in self._event_listeners if l != callback]
+
+    def _on_event(self, frame):
+
+        if loglevel >= DEBUG:
+            log("<<< %s (unsolicited)" % " ".join(str(i) for i in frame), DEBUG)
+
+        event = {
+            "time": time.time(),
+            "address": self._device["address"] if self._device else None,
+            "sequence": frame[2],
+            "command": frame[3],
+            "payload": frame[4:-1]
+        }
+        for callback in self._event_listeners:
+            try:
+                callback(event)
+            except:
+                log("event listener failed", ERROR)
+
+    def start_reader(self):
+
+        if self._reader:
+            return
+
+        if self._client_socket:
+            # short timeout so that the reader notices when it is stopped
+            self._client_socket.settimeout(.2)
+
+        self._reader = FrameReader(self._read_link, self._on_event)
+        self._reader.start()
+
+        log("reader started", DEBUG)
+
+    def stop_reader(self):
+
+        if not self._reader:
+            return
+
+        self._reader.stop()
+        self._reader.join()
+        self._reader = None
+
+        if self._client_socket:
+            self._client_socket.settimeout(2)
+
+        log("reader stopped", DEBUG)
+
+    def _send(self, data, lresponse=32):
+
+        # one request and its response at a time per dock
+        with self._lock:
+            # any other write of the clock replaces a precise sync
+            if data[3] == 17 and data[4] == 8:
+                self._synced_precisely = False
+
+            return self._transmit(data, lresponse)
+
+    def _transmit(self, data, lresponse):
+
+        raw = []
+        try:
+            if loglevel >= DEBUG:
+                log(">>> %s" % (" ".join(str(i) for i in data)), DEBUG)
+
+            if self._reader:
+                self._reader.expect(data[2])
+                self._write_link(data)
+                raw = self._reader.wait(data[2], 2)
+
+            elif self._serial or self._client_socket:
+                self._write_link(data)
+                raw = self._receive(data[2], 2)
+
+                if self._serial and raw and lresponse != len(raw):
+                    log("Length of response is %i but expected %i" %
+                        (len(raw), lresponse), WARN)
+
+        except:
+            log("request failed", ERROR)
+
+        # dump once when the link fails, not for every further empty reply
+        if not raw and not self._link_failed:
+            self.dump_capture()
+        self._link_failed = not raw
+
+        if loglevel >= DEBUG:
+            log("<<< %s (%i bytes)" % (" ".join(str(i)
+                for i in raw), len(raw)), DEBUG)
+        return raw
+
+    def _receive(self, seq, timeout):
+
+        # without reader the reply is picked by its sequence no. here,
+        # other frames in between are unsolicited events
+        reply = []
+        deadline = time.time() + timeout
+        while True:
+            frames, self._received = split_frames(self._received)
+            for frame in frames:
+                if not reply and frame[2] == seq:
+                    reply = frame
+                else:
+                    self._on_event(frame)
+
+            if reply or time.time() >= deadline:
+                break
+
+            self._received += list(self._read_link())
+
+        if not reply:
+            # drop incomplete frames, so that the next reply is not corrupted
+            self._received = list()
+
+        return reply
+
+    def _get_timestamp_as_array(self, dt_now=None):
+
+        dt_now = dt_now or datetime.datetime.now()
+
+        cc = dt_now.year // 100
+        yy = dt_now.year % 100
+        mm = dt_now.month - 1
+        dd = dt_now.day
         h24 = dt_now.hour
         m = dt_now.minute
         s = dt_now.second
@@ -443,21 +1273,6 @@ class AS111():
 
     def request_device_info(self):
 
-        def parse_capabilities(caps):
-
-            caps.reverse()
-            supported = list()
-            i = 0
-
-            for c in caps:
-                for bit in range(0, 8):
-                    r = c >> (i % 8)
-                    if r & 1 == 1:
-                        supported.append(self._capabilities[i])
-                    i += 1
-
-            self._device["capabilities"] = supported
-
         # request device name
         log("request device name", DEBUG)
 
@@ -478,15 +1293,28 @@ class AS111():
             self._device["version"], INFO)
 
         # request device volume
-        log("request current volume", DEBUG)
+        self.request_volume()
 
-        request = self._get_request(15, [0])
-        raw = self._send(request, lresponse=7)
-        self._device["volume"] = raw[-2]
+        # request device capabilities
+        self.request_capabilities()
 
-        log("current volume is %i" % self._device["volume"], INFO)
+    def request_capabilities(self):
+
+        def parse_capabilities(caps):
+
+            caps.reverse()
+            supported = list()
+            i = 0
+
+            for c in caps:
+                for bit in range(0, 8):
+                    r = c >> (i % 8)
+                    if r & 1 == 1 and i < len(self._capabilities):
+                        supported.append(self._capabilities[i])
+                    i += 1
+
+            self._device["capabilities"] = supported
 
-        # request device capabilities
         log("request device capabilities", DEBUG)
 
         raw = self._send(self._get_request(6), lresponse=13)
@@ -494,6 +1322,21 @@ class AS111():
         log("device capabilities requested: %s" %
             ", ".join(self._device["capabilities"]), DEBUG)
 
+        return self._device["capabilities"]
+
+    def request_volume(self):
+
+        log("request current volume", DEBUG)
+
+        request = self._get_request(15, [0])
+        raw = self._send(request, lresponse=7)
+        if len(raw) >= 7:
+            self._device["volume"] = raw[-2]
+
+        log("current volume is %i" % self._device["volume"], INFO)
+
+        return self._device["volume"]
+
     def sync_time(self):
 
         ts = self._get_timestamp_as_array()
@@ -508,6 +1351,77 @@ class AS111():
 
         log("time synced", DEBUG)
 
+    def measure_round_trip(self, samples=_SYNC_SAMPLES):
+
+        rtts = list()
+        for i in range(samples):
+            request = self._get_request(15, [0])
+            before = time.time()
+            raw = self._send(request, lresponse=7)
+            if raw:
+                rtts.append(time.time() - before)
+
+        if len(rtts) == 0:
+            return None
+
+        log("round trip min. %.1f ms, max. %.1f ms" %
+            (min(rtts) * 1000, max(rtts) * 1000), DEBUG)
+
+        # the fastest sample has the least queueing in it
+        return min(rtts)
+
+    def sync_time_precise(self):
+
+        rtt = self.measure_round_trip()
+        if rtt == None:
+            log("unable to measure round trip, sync time roughly", WARN)
+            self.sync_time()
+            return None
+
+        # send so that the frame arrives when the next second begins
+        one_way = rtt / 2
+        boundary = math.floor(time.time() + one_way + self._SYNC_MIN_LEAD) + 1
+        send_at = boundary - one_way
+
+        ts = self._get_timestamp_as_array(
+            datetime.datetime.fromtimestamp(boundary))
+        ts_string = "%02d%02d-%02d-%02d %02d:%02d:%02d" % (ts[0], ts[1],
+                                                           ts[2] + 1, ts[3], ts[4], ts[5], ts[6])
+        request = self._get_request(17, [8] + ts)
+
+        log("sync time precisely to %s" % ts_string, INFO)
+
+        try:
+            # sleep coarsely, then spin for the last milliseconds
+            time.sleep(max(0, send_at - time.time() - self._SYNC_SPIN))
+            while time.time() < send_at:
+                pass
+        except:
+            log("time sync interrupted", WARN)
+            return None
+
+        sent = time.time()
+        raw = self._send(request, lresponse=6)
+        acked = time.time()
+
+        if not raw:
+            log("dock did not acknowledge time", WARN)
+            return None
+
+        self._device["datetime"] = ts_string
+        self._synced_precisely = True
+
+        # arrival is estimated at the middle of this round trip
+        residual = sent + (acked - sent) / 2 - boundary
+        log("time synced with estimated error of %+.1f ms (round trip %.1f ms)" %
+            (residual * 1000, (acked - sent) * 1000), INFO)
+
+        return residual
+
+    def is_synced_precisely(self):
+
+        return self._synced_precisely
+
     def display_mins_n_secs(self, secs):
 
         while (secs >= 0 and not self.is_stop_signal()):
@@ -635,6 +1549,103 @@ class AS111():
 
         log("volume set to %i" % vol, DEBUG)
 
+    def _write_volume(self, vol):
+
+        request = self._get_request(17, [0, vol])
+        raw = self._send(request, lresponse=6)
+
+        # dock acknowledges with 153 4 <seq> 4 0 <checksum>
+        if len(raw) < 5 or raw[2] != request[2] or raw[4] != 0:
+            return False
+
+        self._device["volume"] = vol
+        return True
+
+    def _ramp_curve(self, curve, p):
+
+        if curve == "exp":
+            return (math.exp(self._RAMP_EXP_K * p) - 1) / (math.exp(self._RAMP_EXP_K) - 1)
+
+        return p
+
+    def _ramp_curve_inverse(self, curve, y):
+
+        if curve == "exp":
+            return math.log(1 + y * (math.exp(self._RAMP_EXP_K) - 1)) / self._RAMP_EXP_K
+
+        return y
+
+    def ramp_volume(self, vol, secs, curve="linear"):
+
+        vol = vol if vol <= 32 else 32
+        vol = vol if vol >= 0 else 0
+        curve = curve if curve == "exp" else "linear"
+
+        start = self._device["volume"]
+        fine = self._has_sink_volume()
+        sink_volume = self._device["sink_volume"] if fine else 0
+
+        log("Ramp volume from %i to %i in %i seconds (%s%s)" %
+            (start, vol, secs, curve, ", fine" if fine else ""), INFO)
+
+        began = time.time()
+        sent = start
+        frames = 0
+        rtt = 0.0
+
+        while not self.is_stop_signal():
+
+            p = 1.0 if secs <= 0 else min(1.0, (time.time() - began) / secs)
+            level = start + (vol - start) * self._ramp_curve(curve, p)
+
+            # jump straight to the level of now, so a slow link skips steps
+            # instead of queueing them up
+            dock_level = int(math.ceil(level) if fine else round(level))
+            if dock_level != sent:
+
+                before = time.time()
+                if not self._write_volume(dock_level):
+                    log("dock did not acknowledge volume %i" % dock_level, WARN)
+                    self.request_volume()
+                    break
+
+                rtt = max(rtt, time.time() - before)
+                sent = dock_level
+                frames += 1
+
+            if fine:
+                self._set_sink_volume(
+                    sink_volume * level / dock_level if dock_level else sink_volume)
+
+            if p >= 1.0:
+                break
+
+            # sleep until the curve reaches the next dock level
+            if fine:
+                wait = self._RAMP_FINE_TICK
+
+            elif vol == start:
+                wait = began + secs - time.time()
+
+            else:
+                _next = sent + (.5 if vol > start else -.5)
+                _y = min(1.0, max(0.0, (_next - start) / (vol - start)))
+                wait = began + secs * \
+                    self._ramp_curve_inverse(curve, _y) - time.time()
+
+            try:
+                time.sleep(min(max(wait, rtt, .001), secs))
+            except:
+                log("ramping volume interrupted", WARN)
+                break
+
+        if fine:
+            self._set_sink_volume(sink_volume)
+
+        actual = self.request_volume()
+        log("volume ramped to %i with %i frames (max. round trip %i ms)" %
+            (actual, frames, rtt * 1000), DEBUG)
+
     def set_alarm_led(self, status):
 
         status = status if status == 1 else 0
@@ -668,6 +1679,55 @@ class AS111():
 
         log("blinked led set for %i seconds" % secs, DEBUG)
 
+    def listen(self, secs):
+
+        events = queue.Queue()
+        self.add_event_listener(events.put)
+        self.start_reader()
+
+        log("Listen for dock events%s" %
+            (" for %i seconds" % secs if secs > 0 else ""), INFO)
+
+        until = time.time() + secs
+        try:
+            while (secs <= 0 or time.time() < until) and not self.is_stop_signal():
+                try:
+                    event = events.get(
+                        timeout=.5 if secs <= 0 else min(.5, max(.01, until - time.time())))
+                except queue.Empty:
+                    continue
+
+                print(json.dumps(event))
+                sys.stdout.flush()
+
+        except:
+            log("listening interrupted", WARN)
+
+        self.remove_event_listener(events.put)
+
+
+class AS111Session(AS111):
+
+    def __init__(self, address, devices=None):
+
+        AS111.__init__(self, devices=devices)
+        self._address = address
+
+    def get_address(self):
+
+        return self._address
+
+    def __enter__(self):
+
+        if not self.connect(self._address):
+            raise IOError("Unable to connect to %s" % self._address)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.disconnect()
+
 
 def print_docks(as111):
 
@@ -706,7 +1766,14 @@ def print_json(device):
 def print_help():
 
     print("""
- USAGE:   as111.py <mac|alias|-|--|docks|stop> [command1] [params] [command2] ...
+ USAGE:   as111.py <mac|alias|-|--|docks|monitor|stop> [command1] [params] [command2] ...
+          as111.py replay <file.cap> [emulate|bench]
+          as111.py batch < commands.jsonl
+          as111.py emulate [port]
+          as111.py telemetry <mac|alias|-|--> <interval> [csv|json] [file]
+          as111.py mirror [mac|alias|-|--]
+          as111.py agent [port]
+          as111.py relay <host[:port],...> <mac|alias|-|--> [command1] [params] ...
  EXAMPLE: Set volume to 12
           $ ./as111.py vol 12
 
@@ -716,11 +1783,22 @@ def print_help():
  <mac|alias|-|docks>     Use specific mac, alias
                          Use "-" for current connected (and sinked) dock
                          Use "--" to perform commands for all connected docks
-                         "docks" lists all paired docking stations
+                         "docks [rescan]" lists all paired docking stations
+                         "monitor" keeps the cached list of docks up-to-date until stopped
                          "stop" sends a signal in order to terminate a running as111 process
+                         "replay" decodes a capture file, compares it with the emulator or benchmarks the parser
+                         "batch" reads JSON commands line by line from stdin and keeps docks connected
+                         "emulate" starts an emulated dock which is reachable as tcp://127.0.0.1:<port>
+                         "telemetry" polls volume, charging and power state until stopped
+                         "mirror" keeps volume of docks and their audio sinks in sync until stopped
+                         "agent" serves local docks to relays over TCP until stopped
+                         "relay" performs commands on docks of several agents at the same time
  sync                    Synchronizes time between PC and dock
+ sync-precise            Synchronizes time on the second, compensates transmission delay
  vol [+-]<0-32>          Sets volume to value which is between 0 and 32
  mute                    Sets volume to 0
+ ramp [+-]<0-32> <secs> [linear|exp]
+                         Fades volume within <secs> seconds, uses sink volume for finer steps
  sink                    Sets this device as audio sink
  
  alarm-led <off|on>      Activates / deactivates alarm LED
@@ -736,201 +1814,751 @@ def print_help():
 
  Other:
  stop                    use in order to stop long running thread, e.g. as111.py stop
+ listen [secs]           Prints unsolicited dock events as JSON lines until stopped
+ capture [file.cap]      Writes the last 1024 packets to a capture file
  info                    Prints device info
  list-codecs             lists supported codecs
  switch-codec <codec>    switch to codec
  json                    Prints device info in JSON format
  verbose                 Verbose mode
  debug                   Debug mode
+ profile [trace.json]    Prints time spent per phase and command, optionally writes Chrome trace
  help                    Information about usage, commands and parameters
     """)
 
 
-def do_commands(as111, address, commands):
+def replay(filename, mode):
 
-    connected = as111.connect(address)
-    if not connected:
-        log("Unable to connect to %s" % address)
-        return False
+    frames = PacketCapture.load(filename)
+    if len(frames) == 0:
+        log("capture is empty", WARN)
+        return True
 
-    # process commands
-    commands = commands.copy()
-    while(len(commands) > 0):
-        command = commands[0]
-        commands = commands[1:]
+    if mode == "bench":
 
-        if command == "sink":
-            as111.set_sink()
+        stream = list()
+        for ts, direction, data in frames:
+            stream += list(data)
 
-        elif command == "vol":
-            if commands[0][0] in "-+":
-                device = as111.get_current_device()
-                vol = device["volume"] + int(commands[0])
-            else:
-                vol = int(commands[0])
+        count = 0
+        rounds = 0
+        before = time.time()
+        while time.time() - before < 1 or rounds == 0:
+            count += len(split_frames(stream)[0])
+            rounds += 1
 
-            try:
-                as111.set_volume(vol)
-            except:
-                log("Volume must be between 0 and 32", ERROR)
-                return False
+        elapsed = time.time() - before
+        print("%i bytes, %i frames per round, %i rounds in %.3f s, %.0f frames/s" %
+              (len(stream), count // rounds, rounds, elapsed, count / elapsed))
+        return True
 
-            commands = commands[1:]
+    # split both directions into frames while keeping their order
+    decoded = list()
+    buf = {PacketCapture.OUT: [], PacketCapture.IN: []}
+    for ts, direction, data in frames:
+        _frames, buf[direction] = split_frames(buf[direction] + list(data))
+        decoded += [(ts, direction, f) for f in _frames]
 
-        elif command == "mute":
+    if mode == "emulate":
 
-            as111.set_volume(0)
+        emulator = DockEmulator()
+        replies = dict()
+        for ts, direction, frame in decoded:
+            if direction == PacketCapture.IN:
+                replies.setdefault(frame[2], list()).append(frame)
 
-        elif command == "alarm-led":
+        failed = 0
+        for ts, direction, frame in decoded:
+            if direction != PacketCapture.OUT:
+                continue
 
-            if commands[0] == "blink":
-                try:
-                    as111.blink_alarm_led(int(commands[1]))
-                    commands = commands[1:]
-                except:
-                    log("seconds must be given and numeric", ERROR)
-            else:
-                status = 1 if commands[0] == "on" else 0
-                as111.set_alarm_led(status)
+            expected = emulator.handle(frame)
+            recorded = replies.get(frame[2], [[]])
+            actual = recorded.pop(0) if len(recorded) > 0 else []
 
-            commands = commands[1:]
+            if len(actual) < 4 or actual[3] != expected[3]:
+                failed += 1
+                print(">>> %s\n<<< %s\n    expected %s" % (" ".join(str(i) for i in frame), " ".join(
+                    str(i) for i in actual) or "(no reply)", " ".join(str(i) for i in expected)))
 
-        elif command == "sleep":
+        print("%i of %i requests differ from emulator" %
+              (failed, len([d for d in decoded if d[1] == PacketCapture.OUT])))
+        return failed == 0
 
-            try:
-                secs = int(commands[0])
-            except:
-                log("seconds must be numeric", ERROR)
-                return False
+    start = decoded[0][0] if decoded else 0
+    for ts, direction, frame in decoded:
+        print("%9.3f %s %s" % (ts - start, ">>>" if direction ==
+                               PacketCapture.OUT else "<<<", " ".join(str(i) for i in frame)))
 
-            try:
-                time.sleep(secs)
-            except:
-                log("sleeping interrupted", WARN)
+    for direction in buf:
+        if buf[direction]:
+            print("incomplete frame: %s" % " ".join(str(i) for i in buf[direction]))
 
-            commands = commands[1:]
+    return True
 
-        elif command == "sync":
 
-            as111.sync_time()
+class CronSpec():
 
-        elif command == "countdown" or command == "countup":
+    _RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
 
-            try:
-                param = commands[0].split(":")
-                minutes = int(param[0])
-                secs = 0 if len(param) != 2 else int(param[1])
-            except:
-                log("time must be given in numeric format mm:ss", ERROR)
-                return False
+    def __init__(self, spec):
 
-            as111.countdown(minutes, secs, -1 if command == "countdown" else 1)
-            commands = commands[1:]
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError("cron spec must have 5 fields: %s" % spec)
 
-        elif command == "mins-n-secs":
+        self._sets = [self._parse(f, lo, hi)
+                      for f, (lo, hi) in zip(fields, self._RANGES)]
 
-            try:
-                secs = int(commands[0])
-            except:
-                log("seconds must be numeric", ERROR)
-                return False
-            as111.display_mins_n_secs(secs)
-            commands = commands[1:]
+    def _parse(self, field, lo, hi):
 
-        elif command == "date":
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
 
-            as111.display_date()
+            if part == "*":
+                first, last = lo, hi
+            elif "-" in part:
+                first, last = map(int, part.split("-"))
+            else:
+                first = last = int(part)
 
-        elif command == "display":
+            if first < lo or last > hi or step < 1:
+                raise ValueError("%s out of range %i-%i" % (field, lo, hi))
 
-            try:
-                secs = int(commands[0]) % 60
-                number = int(commands[1])
-            except:
-                log("seconds must be numeric", ERROR)
-                return False
+            values.update(range(first, last + 1, step))
 
-            as111.display_number(secs, number)
-            commands = commands[2:]
+        return values
 
-        elif command == "list-codecs":
+    def next(self, after):
 
-            success, codecs = as111.get_supported_codecs()
-            if success:
-                print(json.dumps(codecs, indent=2))
-            else:
-                log("Codecs maybe not supported on your system?", ERROR)
-                return False
+        minutes, hours, days, months, weekdays = self._sets
 
-        elif command == "switch-codec":
+        dt = datetime.datetime.fromtimestamp(
+            after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt + datetime.timedelta(days=366 * 4)
 
-            try:
-                success = as111.set_codec(commands[0])
-                if not success:
-                    log("Switch to codec \"%s\" failed" % commands[0], ERROR)
-                commands = commands[1:]
-            except:
-                log("Codec must be given", ERROR)
-                return False
+        # like cron, day of month and day of week are or-ed if both are restricted
+        either = len(days) < 31 and len(weekdays) < 7
 
-        elif command == "info":
+        while dt < limit:
+            day_ok = [dt.day in days, (dt.weekday() + 1) % 7 in weekdays]
+            if dt.month not in months:
+                dt = (dt.replace(day=1, hour=0, minute=0) +
+                      datetime.timedelta(days=32)).replace(day=1)
+            elif not (any(day_ok) if either else all(day_ok)):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt.timestamp()
 
-            print_info(as111.get_current_device())
+        return None
 
-        elif command == "json":
 
-            print_json(as111.get_current_device())
+class Scheduler(threading.Thread):
 
-        elif command == "debug":
+    def __init__(self, execute):
 
-            loglevel = DEBUG
+        threading.Thread.__init__(self, daemon=True)
+        self._execute = execute
+        self._heap = list()
+        self._jobs = dict()
+        self._ids = 0
+        self._cond = threading.Condition()
+        self._stopped = False
 
-        elif command == "verbose":
+    def _next(self, job, after):
 
-            loglevel = INFO
+        when = job["when"]
+        if when.startswith("@every "):
+            interval = float(when[7:])
+            if interval <= 0:
+                raise ValueError("interval must be positive")
 
-    as111.sync_time()
-    as111.disconnect()
+            # stay on the grid but skip runs that have been missed
+            _next = after + interval
+            while _next <= time.time():
+                _next += interval
+            return _next
 
-    return True
+        elif when.startswith("@in "):
+            return None if job["runs"] else job["created"] + float(when[4:])
 
+        elif when.startswith("@at "):
+            if job["runs"]:
+                return None
+
+            # today or tomorrow at HH:MM[:SS]
+            t = list(map(int, when[4:].split(":"))) + [0]
+            dt = datetime.datetime.fromtimestamp(after).replace(
+                hour=t[0], minute=t[1], second=t[2], microsecond=0)
+            if dt.timestamp() <= after:
+                dt += datetime.timedelta(days=1)
 
-if __name__ == "__main__":
+            return dt.timestamp()
 
-    if len(sys.argv) < 2:
-        print_help()
-        exit(1)
+        return job["cron"].next(after)
 
-    if len(sys.argv) > 2 and sys.argv[2] in ["debug", "verbose"]:
+    def add(self, when, dock, commands):
 
-        loglevel = DEBUG if sys.argv[2] == "debug" else INFO
+        job = {
+            "id": 0,
+            "when": when.strip(),
+            "dock": dock,
+            "commands": commands,
+            "created": time.time(),
+            "runs": 0,
+            "next": None,
+            "cron": None
+        }
 
-    as111 = AS111()
-    if sys.argv[1] == "stop":
-        log("Set stop signal", INFO)
-        as111.set_stop_signal()
-        exit(0)
+        if not job["when"].startswith("@"):
+            job["cron"] = CronSpec(job["when"])
 
-    elif sys.argv[1] == "docks":
-        print_docks(as111)
-        exit(0)
+        job["next"] = self._next(job, job["created"])
+        if job["next"] == None:
+            raise ValueError("schedule %s never fires" % when)
 
-    elif sys.argv[1] == "help":
+        with self._cond:
+            self._ids += 1
+            job["id"] = self._ids
+            self._jobs[job["id"]] = job
+            heapq.heappush(self._heap, (job["next"], job["id"]))
+            self._cond.notify()
 
-        print_help()
-        exit(0)
+        log("scheduled job %i at %s" % (job["id"], time.ctime(job["next"])), INFO)
 
+        return job["id"]
+
+    def cancel(self, id):
+
+        # job stays in heap and is dropped when it comes up
+        with self._cond:
+            return self._jobs.pop(id, None) != None
+
+    def get_jobs(self):
+
+        with self._cond:
+            return [{
+                "id": j["id"],
+                "when": j["when"],
+                "dock": j["dock"],
+                "commands": j["commands"],
+                "next": j["next"],
+                "runs": j["runs"]
+            } for j in sorted(self._jobs.values(), key=lambda j: j["next"])]
+
+    def has_jobs(self):
+
+        with self._cond:
+            return len(self._jobs) > 0
+
+    def stop(self):
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if len(self._heap) == 0:
+                        self._cond.wait()
+                        continue
+
+                    due, id = self._heap[0]
+                    job = self._jobs.get(id, None)
+                    if not job or job["next"] != due:
+                        heapq.heappop(self._heap)
+                        continue
+
+                    now = time.time()
+                    if due > now:
+                        self._cond.wait(due - now)
+                        continue
+
+                    heapq.heappop(self._heap)
+                    job["runs"] += 1
+                    job["next"] = self._next(
+                        job, due if job["when"].startswith("@every ") else max(now, due))
+                    if job["next"] == None:
+                        del self._jobs[id]
+                    else:
+                        heapq.heappush(self._heap, (job["next"], id))
+                    break
+
+                if self._stopped:
+                    return
+
+            threading.Thread(target=self._execute, args=(job,), daemon=True).start()
+
+
+class ConnectionPool():
+
+    def __init__(self, as111):
+
+        self._as111 = as111
+        self._connections = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def get(self, address):
+
+        if address in self._connections:
+            if not self._connections[address].is_link_failed():
+                return self._connections[address]
+
+            log("reconnect to %s" % address, WARN)
+            self.close(address)
+
+        connection = self._as111.session(address)
+        if not connection.connect(address):
+            log("Unable to connect to %s" % address, ERROR)
+            return None
+
+        self._connections[address] = connection
+        return connection
+
+    def lock(self, address):
+
+        with self._lock:
+            if address not in self._locks:
+                self._locks[address] = threading.RLock()
+
+            return self._locks[address]
+
+    def get_addresses(self):
+
+        return list(self._connections.keys())
+
+    def close(self, address):
+
+        connection = self._connections.pop(address, None)
+        if connection:
+            # a coarse sync would undo a precise one
+            if not connection.is_synced_precisely():
+                connection.sync_time()
+            connection.disconnect()
+
+    def close_all(self):
+
+        for address in self.get_addresses():
+            self.close(address)
+
+
+class TelemetryRing():
+
+    def __init__(self, size):
+
+        self._size = size
+        self._next = 0
+        self._count = 0
+        self._appended = 0
+        self._times = array.array("d", [0.0]) * size
+        self._volumes = array.array("B", [0]) * size
+        self._flags = array.array("B", [0]) * size
+
+    def append(self, ts, volume, flags):
+
+        self._times[self._next] = ts
+        self._volumes[self._next] = volume
+        self._flags[self._next] = flags
+        self._next = (self._next + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+        self._appended += 1
+
+    def __len__(self):
+
+        return self._count
+
+    def get_appended(self):
+
+        return self._appended
+
+    def latest(self, n):
+
+        n = min(n, self._count)
+        for i in range(n):
+            j = (self._next - n + i) % self._size
+            yield self._times[j], self._volumes[j], self._flags[j]
+
+    def samples(self, since=0, until=None):
+
+        start = (self._next - self._count) % self._size
+        for i in range(self._count):
+            j = (start + i) % self._size
+            if self._times[j] < since:
+                continue
+            elif until != None and self._times[j] > until:
+                break
+
+            yield self._times[j], self._volumes[j], self._flags[j]
+
+
+class Telemetry():
+
+    CHARGING = 1
+    BATTERY = 2
+    AC_DC_POWER_MODE = 4
+
+    _FLAGS = [("6-CHARGING", CHARGING), ("7-BATTERY", BATTERY),
+              ("15-AC_DC_POWER_MODE", AC_DC_POWER_MODE)]
+
+    def __init__(self, pool, size=60480):
+
+        self._pool = pool
+        self._size = size
+        self._rings = dict()
+        self._exported = dict()
+        self._lock = threading.Lock()
+
+    def poll(self, addresses):
+
+        for address in addresses:
+            with self._pool.lock(address):
+                connection = self._pool.get(address)
+                if not connection:
+                    continue
+
+                volume = connection.request_volume()
+                failed = connection.is_link_failed()
+                capabilities = connection.request_capabilities()
+                if failed or connection.is_link_failed():
+                    continue
+
+            flags = 0
+            for capability, flag in self._FLAGS:
+                if capability in capabilities:
+                    flags |= flag
+
+            with self._lock:
+                if address not in self._rings:
+                    self._rings[address] = TelemetryRing(self._size)
+                self._rings[address].append(time.time(), volume, flags)
+
+    def run(self, get_addresses, interval, is_stopped, on_poll=None):
+
+        next_poll = time.time()
+        while not is_stopped():
+            self.poll(get_addresses())
+            if on_poll:
+                on_poll()
+
+            # sleep in slices, so that a stop signal is not missed for long
+            next_poll += interval
+            while not is_stopped() and time.time() < next_poll:
+                time.sleep(max(0, min(1, next_poll - time.time())))
+
+    def _to_dict(self, address, ts, volume, flags):
+
+        return {
+            "address": address,
+            "time": ts,
+            "volume": volume,
+            "charging": flags & self.CHARGING != 0,
+            "battery": flags & self.BATTERY != 0,
+            "ac_dc_power_mode": flags & self.AC_DC_POWER_MODE != 0
+        }
+
+    def _samples(self, address=None, since=0, until=None):
+
+        # yields one sample at a time, the caller holds the lock
+        addresses = [address] if address else sorted(self._rings.keys())
+        for _address in addresses:
+            if _address not in self._rings:
+                continue
+
+            for ts, volume, flags in self._rings[_address].samples(since, until):
+                yield self._to_dict(_address, ts, volume, flags)
+
+    def _new_samples(self):
+
+        # samples that have been appended since the last call
+        for _address in sorted(self._rings.keys()):
+            ring = self._rings[_address]
+            n = ring.get_appended() - self._exported.get(_address, 0)
+            self._exported[_address] = ring.get_appended()
+            for ts, volume, flags in ring.latest(n):
+                yield self._to_dict(_address, ts, volume, flags)
+
+    def query(self, address=None, since=0, until=None):
+
+        with self._lock:
+            return list(self._samples(address, since, until))
+
+    def _write_csv(self, out, samples):
+
+        for s in samples:
+            out.write("%s,%.3f,%i,%i,%i,%i\n" % (s["address"], s["time"], s["volume"],
+                                                 s["charging"], s["battery"], s["ac_dc_power_mode"]))
+
+    def _write_json(self, out, samples):
+
+        # items of a list as json.dump(..., indent=2) writes them
+        n = 0
+        for s in samples:
+            out.write("%s  %s" % (",\n" if n else "",
+                                  json.dumps(s, indent=2).replace("\n", "\n  ")))
+            n += 1
+
+        return n
+
+    def export_csv(self, out, address=None, since=0, until=None):
+
+        out.write("address,time,volume,charging,battery,ac_dc_power_mode\n")
+        with self._lock:
+            self._write_csv(out, self._samples(address, since, until))
+
+    def export_json(self, out, address=None, since=0, until=None):
+
+        out.write("[\n")
+        with self._lock:
+            n = self._write_json(out, self._samples(address, since, until))
+        out.write("\n]\n" if n else "]\n")
+
+    def export_new_csv(self, out):
+
+        with self._lock:
+            self._write_csv(out, self._new_samples())
+
+    def export_new_json(self, out):
+
+        with self._lock:
+            return self._write_json(out, self._new_samples())
+
+
+def do_telemetry(as111, target, interval, fmt, filename):
+
+    pool = ConnectionPool(as111)
+    telemetry = Telemetry(pool)
+
+    def export():
+
+        out = open(filename + ".tmp", "w") if filename else sys.stdout
+        if fmt == "json":
+            telemetry.export_json(out)
+        else:
+            telemetry.export_csv(out)
+
+        if filename:
+            out.close()
+            os.replace(filename + ".tmp", filename)
+
+    exported = [0]
+
+    def export_new():
+
+        # append samples of the last poll instead of rewriting the whole file
+        if fmt != "json":
+            with open(filename, "a") as out:
+                telemetry.export_new_csv(out)
+            return
+
+        chunk = io.StringIO()
+        n = telemetry.export_new_json(chunk)
+        if n == 0:
+            return
+
+        # replace the closing "]" of the list
+        with open(filename, "rb+") as out:
+            out.seek(-3 if exported[0] else -2, os.SEEK_END)
+            out.write(("%s%s\n]\n" % (",\n" if exported[0] else "",
+                                       chunk.getvalue())).encode("utf8"))
+        exported[0] += n
+
+    log("Collect telemetry every %i seconds" % interval, INFO)
+
+    if filename:
+        export()
+
+    try:
+        telemetry.run(lambda: resolve_addresses(as111, target) or [],
+                      interval, as111.is_stop_signal, export_new if filename else None)
+    except:
+        log("collecting telemetry interrupted", WARN)
+
+    pool.close_all()
+    export()
+
+
+class VolumeMirror():
+
+    SINK_FULL = 65536
+
+    _DEBOUNCE = .05
+    _MAX_DELAY = .25
+    _POLL = 5
+
+    def __init__(self, as111, addresses):
+
+        self._as111 = as111
+        self._pool = ConnectionPool(as111)
+        self._lock = threading.Lock()
+        self._addresses = list()
+        self._sinks = dict()
+        self._volumes = dict()
+
+        sinks = as111.request_sink_volumes()
+        for address in addresses:
+            if address not in sinks:
+                log("%s has no sink, skipped" % address, WARN)
+                continue
+
+            connection = self._pool.get(address)
+            if not connection:
+                continue
+
+            self._addresses.append(address)
+            self._sinks[address] = next(
+                filter(lambda d: d["address"] == address, as111.get_devices()))["sink"]
+            self._volumes[address] = connection.get_current_device()[
+                "volume"]
+
+            connection.add_event_listener(self._on_dock_event)
+            connection.start_reader()
+
+    def to_dock(self, sink_volume):
+
+        return min(32, max(0, int(round(32.0 * sink_volume / self.SINK_FULL))))
+
+    def to_sink(self, volume):
+
+        return volume * self.SINK_FULL // 32
+
+    def sync_to_docks(self):
+
+        sinks = self._as111.request_sink_volumes()
+        for address in self._addresses:
+            if address not in sinks:
+                continue
+
+            volume = self.to_dock(sinks[address])
+            with self._lock:
+                if volume == self._volumes[address]:
+                    continue
+                self._volumes[address] = volume
+
+            log("sink -> %s: volume %i" % (address, volume), INFO)
+            with self._pool.lock(address):
+                connection = self._pool.get(address)
+                if connection:
+                    connection.set_volume(volume)
+
+    def _sync_to_sink(self, address, volume):
+
+        with self._lock:
+            if volume == self._volumes[address]:
+                return
+            self._volumes[address] = volume
+
+        # the change event of the sink maps back to this volume and stops there
+        log("%s -> sink: volume %i" % (address, volume), INFO)
+        self._as111._pacmd(["set-sink-volume", self._sinks[address],
+                            "%i" % self.to_sink(volume)])
+
+    def _on_dock_event(self, event):
+
+        # volume reports look like responses to request 15: 16 0 <volume>
+        if event["command"] == 16 and len(event["payload"]) >= 2 and event["address"] in self._volumes:
+            self._sync_to_sink(event["address"], event["payload"][-1])
+
+    def poll_docks(self):
+
+        for address in self._addresses:
+            with self._pool.lock(address):
+                connection = self._pool.get(address)
+                if not connection:
+                    continue
+
+                volume = connection.request_volume()
+                if connection.is_link_failed():
+                    continue
+
+            self._sync_to_sink(address, volume)
+
+    def run(self, is_stopped):
+
+        if len(self._addresses) == 0:
+            log("No dock with audio sink to mirror", ERROR)
+            return False
+
+        p = subprocess.Popen(["pactl", "subscribe"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+        log("Mirror volume of %s" % ", ".join(self._addresses), INFO)
+
+        # the sink leads, so that docks and sinks start in line
+        self.sync_to_docks()
+
+        first_event = None
+        last_event = None
+        next_poll = time.time() + self._POLL
+        try:
+            while not is_stopped() and p.poll() is None:
+
+                # flush when the slider rests or after the longest delay
+                due = min(last_event + self._DEBOUNCE, first_event +
+                          self._MAX_DELAY) if first_event else next_poll
+                ready, _, _ = select.select(
+                    [p.stdout], [], [], max(0, min(due, next_poll, time.time() + 1) - time.time()))
+
+                if ready:
+                    line = p.stdout.readline().decode("utf8")
+                    if "'change' on sink" in line:
+                        last_event = time.time()
+                        first_event = first_event or last_event
+
+                now = time.time()
+                if first_event and now >= min(last_event + self._DEBOUNCE, first_event + self._MAX_DELAY):
+                    first_event = None
+                    self.sync_to_docks()
+
+                if now >= next_poll:
+                    next_poll = now + self._POLL
+                    self.poll_docks()
+
+        except:
+            log("mirroring interrupted", WARN)
+
+        p.terminate()
+        self._pool.close_all()
+        return True
+
+
+def resolve_addresses(as111, target):
+
+    # explicit targets do not need a connected bluetooth device
+    if target not in ["-", "--"]:
+        address, alias = as111.get_address_n_alias(target)
+        if address == None:
+            log("Unable to resolve address for alias. Check .known_as111 file.", ERROR)
+            return None
+
+        elif alias:
+            log("Found alias \"%s\"" % alias, INFO)
+
+        return [address]
+
+    as111.refresh_devices_if_outdated()
     _devices = as111.get_connected_devices()
     if len(_devices) == 0:
         log("No device connected.", ERROR)
-        exit(1)
+        return None
 
     addresses = list()
-    if sys.argv[1] == "--":
+    if target == "--":
 
         addresses.extend(map(lambda d: d["address"], _devices))
 
-    elif sys.argv[1] == "-":
+    else:
 
         _device = as111.get_running_sink()
         if not _device:
@@ -940,18 +2568,723 @@ if __name__ == "__main__":
         log("use %s, %s" % (address, alias or "(w/o alias)"), INFO)
         addresses.append(address)
 
-    else:
-        address, alias = as111.get_address_n_alias(sys.argv[1])
-        if address == None:
-            log("Unable to resolve address for alias. Check .known_as111 file.", ERROR)
+    return addresses
+
+
+class ThreadOutput():
+
+    def __init__(self, stream):
+
+        self._stream = stream
+        self._local = threading.local()
+
+    def write(self, s):
+
+        buf = getattr(self._local, "buf", None)
+        return buf.write(s) if buf != None else self._stream.write(s)
+
+    def flush(self):
+
+        if getattr(self._local, "buf", None) == None:
+            self._stream.flush()
+
+    def begin(self):
+
+        self._local.buf = io.StringIO()
+
+    def end(self):
+
+        s = self._local.buf.getvalue()
+        self._local.buf = None
+        return s
+
+
+class BatchProcessor():
+
+    def __init__(self, as111, out):
+
+        self._as111 = as111
+        self._out = out
+        self._out_lock = threading.Lock()
+        self._pool = ConnectionPool(as111)
+        self._scheduler = Scheduler(self._run_job)
+
+        # keep output of commands apart from the JSON results
+        self._stdout = ThreadOutput(sys.stdout)
+        sys.stdout = self._stdout
+
+    def _write(self, result):
+
+        with self._out_lock:
+            self._out.write(json.dumps(result) + "\n")
+            self._out.flush()
+
+    def _execute_on(self, address, commands):
+
+        started = None
+        with self._pool.lock(address):
+            if commands[0] == "close":
+                self._pool.close(address)
+                connection = None
+                success = True
+
+            else:
+                connection = self._pool.get(address)
+                started = time.time()
+                success = connection != None and process_commands(
+                    connection, commands)
+
+            return {
+                "dock": address,
+                "ok": success,
+                "started": started,
+                "device": dict(connection.get_current_device()) if connection else None
+            }
+
+    def _execute(self, dock, commands, at=None):
+
+        addresses = resolve_addresses(self._as111, dock) or []
+        if at == None or commands[0] == "close":
+            return [self._execute_on(address, commands) for address in addresses]
+
+        # connect first, so that connecting does not delay the start
+        for address in addresses:
+            with self._pool.lock(address):
+                self._pool.get(address)
+
+        time.sleep(max(0, at - time.time()))
+
+        # start all docks of this host together
+        results = [None] * len(addresses)
+        outputs = [""] * len(addresses)
+
+        def run(i):
+
+            self._stdout.begin()
+            results[i] = self._execute_on(addresses[i], commands)
+            outputs[i] = self._stdout.end()
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(addresses))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for output in outputs:
+            sys.stdout.write(output)
+
+        return results
+
+    def _run_job(self, job):
+
+        self._stdout.begin()
+        try:
+            results = self._execute(job["dock"], job["commands"])
+        except Exception as e:
+            log("job %i failed: %s" % (job["id"], e), ERROR)
+            results = []
+
+        self._write({
+            "ok": len(results) > 0 and all(r["ok"] for r in results),
+            "job": job["id"],
+            "results": results,
+            "output": self._stdout.end()
+        })
+
+    def handle(self, line):
+
+        result = {"ok": False}
+        self._stdout.begin()
+        try:
+            request = json.loads(line)
+            result["id"] = request.get("id", None)
+
+            commands = [request["command"]] + \
+                [str(p) for p in request.get("params", [])]
+
+            if "schedule" in request:
+                result["job"] = self._scheduler.add(
+                    request["schedule"], request.get("dock", "-"), commands)
+                result["ok"] = True
+
+            elif commands[0] == "cancel":
+                result["ok"] = self._scheduler.cancel(int(commands[1]))
+
+            elif commands[0] == "jobs":
+                result["jobs"] = self._scheduler.get_jobs()
+                result["ok"] = True
+
+            elif commands[0] == "time":
+                result["time"] = time.time()
+                result["ok"] = True
+
+            else:
+                # "at" is a start time, e.g. synchronized by a relay
+                result["results"] = self._execute(
+                    request.get("dock", "-"), commands, request.get("at", None))
+                result["ok"] = len(result["results"]) > 0 and all(
+                    r["ok"] for r in result["results"])
+
+                started = [r["started"]
+                           for r in result["results"] if r["started"]]
+                if "at" in request and started:
+                    result["started"] = min(started)
+
+        except Exception as e:
+            log("invalid request: %s" % e, ERROR)
+
+        result["output"] = self._stdout.end()
+        return result
+
+    def start(self):
+
+        self._scheduler.start()
+
+    def run(self, ins):
+
+        self.start()
+
+        while True:
+            line = ins.readline()
+            if not line:
+                break
+
+            elif line.strip():
+                self._write(self.handle(line))
+
+        # stdin is closed but there are still pending jobs
+        try:
+            while self._scheduler.has_jobs() and not self._as111.is_stop_signal():
+                time.sleep(1)
+        except:
+            log("waiting for scheduled jobs interrupted", WARN)
+
+        self.close()
+
+    def close(self):
+
+        self._scheduler.stop()
+        self._pool.close_all()
+        sys.stdout = self._stdout._stream
+
+
+def do_batch(as111, ins, out):
+
+    BatchProcessor(as111, out).run(ins)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        log("relay %s:%i connected" % self.client_address, INFO)
+        while True:
+            try:
+                line = self.rfile.readline()
+            except:
+                break
+
+            if not line:
+                break
+
+            elif not line.strip():
+                continue
+
+            result = self.server.processor.handle(line.decode("utf8"))
+            try:
+                self.wfile.write((json.dumps(result) + "\n").encode("utf8"))
+                self.wfile.flush()
+            except:
+                break
+
+        log("relay %s:%i disconnected" % self.client_address, INFO)
+
+
+class Agent(socketserver.ThreadingTCPServer):
+
+    PORT = 45110
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, as111, port=PORT, host="0.0.0.0"):
+
+        socketserver.ThreadingTCPServer.__init__(
+            self, (host, port), AgentHandler)
+        self.processor = BatchProcessor(as111, sys.stdout)
+
+    def serve(self, is_stopped):
+
+        self.processor.start()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+        log("Agent listens on port %i" % self.server_address[1], INFO)
+
+        try:
+            while not is_stopped():
+                time.sleep(1)
+        except:
+            log("agent interrupted", WARN)
+
+        self.shutdown()
+        self.server_close()
+        self.processor.close()
+
+
+class Relay():
+
+    _SAMPLES = 5
+    _LEAD = .5
+
+    def __init__(self, hosts):
+
+        self._agents = dict()
+        for host in hosts:
+            name, port = host.rsplit(":", 1) if ":" in host else (
+                host, Agent.PORT)
+            conn = socket.create_connection((name, int(port)), timeout=10)
+
+            # the agent replies when the whole command queue is done
+            conn.settimeout(None)
+            self._agents[host] = {
+                "socket": conn,
+                "file": conn.makefile("rw", encoding="utf8"),
+                "offset": 0.0,
+                "rtt": 0.0
+            }
+
+    def _request(self, host, request):
+
+        agent = self._agents[host]
+        agent["file"].write(json.dumps(request) + "\n")
+        agent["file"].flush()
+        return json.loads(agent["file"].readline())
+
+    def estimate_offsets(self):
+
+        for host in self._agents:
+            samples = list()
+            for i in range(self._SAMPLES):
+                before = time.time()
+                remote = self._request(host, {"command": "time"})["time"]
+                after = time.time()
+                samples.append((after - before, remote - (before + after) / 2))
+
+            # the fastest round trip has the most symmetric delays
+            rtt, offset = min(samples)
+            self._agents[host]["rtt"] = rtt
+            self._agents[host]["offset"] = offset
+
+            log("%s: clock offset %+.1f ms, round trip %.1f ms" %
+                (host, offset * 1000, rtt * 1000), INFO)
+
+        return {h: (a["offset"], a["rtt"]) for h, a in self._agents.items()}
+
+    def fan_out(self, dock, commands):
+
+        self.estimate_offsets()
+
+        # start everywhere at the same moment, converted to the agent's clock
+        start = time.time() + self._LEAD + \
+            max(a["rtt"] for a in self._agents.values())
+
+        results = dict()
+
+        def send(host):
+
+            try:
+                results[host] = self._request(host, {
+                    "dock": dock,
+                    "command": commands[0],
+                    "params": commands[1:],
+                    "at": start + self._agents[host]["offset"]
+                })
+                # no start time if no dock could be reached
+                if "started" in results[host]:
+                    results[host]["skew"] = results[host]["started"] - \
+                        self._agents[host]["offset"] - start
+
+            except Exception as e:
+                results[host] = {"ok": False, "output": str(e)}
+
+        threads = [threading.Thread(target=send, args=(h,))
+                   for h in self._agents]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        return results
+
+    def close(self):
+
+        for agent in self._agents.values():
+            try:
+                agent["file"].close()
+                agent["socket"].close()
+            except:
+                pass
+
+
+def do_commands(as111, address, commands):
+
+    with profiler.span("dock %s" % address):
+
+        with profiler.span("connect"):
+            connected = as111.connect(address)
+
+        if not connected:
+            log("Unable to connect to %s" % address)
+            return False
+
+        success = process_commands(as111, commands)
+
+        if not as111.is_synced_precisely():
+            with profiler.span("sync_time"):
+                as111.sync_time()
+
+        with profiler.span("disconnect"):
+            as111.disconnect()
+
+    return success
+
+
+def process_commands(as111, commands):
+
+    commands = commands.copy()
+    while(len(commands) > 0):
+        command = commands[0]
+
+        with profiler.span("command %s" % command):
+            commands = process_command(as111, command, commands[1:])
+
+        if commands == None:
+            return False
+
+    return True
+
+
+def process_command(as111, command, commands):
+
+    if command == "sink":
+        as111.set_sink()
+
+    elif command == "vol":
+        if commands[0][0] in "-+":
+            device = as111.get_current_device()
+            vol = device["volume"] + int(commands[0])
+        else:
+            vol = int(commands[0])
+
+        try:
+            as111.set_volume(vol)
+        except:
+            log("Volume must be between 0 and 32", ERROR)
+            return None
+
+        commands = commands[1:]
+
+    elif command == "ramp":
+
+        try:
+            if commands[0][0] in "-+":
+                device = as111.get_current_device()
+                vol = device["volume"] + int(commands[0])
+            else:
+                vol = int(commands[0])
+            secs = int(commands[1])
+        except:
+            log("volume and seconds must be numeric", ERROR)
+            return None
+
+        commands = commands[2:]
+        curve = "linear"
+        if len(commands) > 0 and commands[0] in ["linear", "exp"]:
+            curve = commands[0]
+            commands = commands[1:]
+
+        as111.ramp_volume(vol, secs, curve)
+
+    elif command == "mute":
+
+        as111.set_volume(0)
+
+    elif command == "alarm-led":
+
+        if commands[0] == "blink":
+            try:
+                as111.blink_alarm_led(int(commands[1]))
+                commands = commands[1:]
+            except:
+                log("seconds must be given and numeric", ERROR)
+        else:
+            status = 1 if commands[0] == "on" else 0
+            as111.set_alarm_led(status)
+
+        commands = commands[1:]
+
+    elif command == "sleep":
+
+        try:
+            secs = int(commands[0])
+        except:
+            log("seconds must be numeric", ERROR)
+            return None
+
+        try:
+            time.sleep(secs)
+        except:
+            log("sleeping interrupted", WARN)
+
+        commands = commands[1:]
+
+    elif command == "sync":
+
+        as111.sync_time()
+
+    elif command == "sync-precise":
+
+        as111.sync_time_precise()
+
+    elif command == "countdown" or command == "countup":
+
+        try:
+            param = commands[0].split(":")
+            minutes = int(param[0])
+            secs = 0 if len(param) != 2 else int(param[1])
+        except:
+            log("time must be given in numeric format mm:ss", ERROR)
+            return None
+
+        as111.countdown(minutes, secs, -1 if command == "countdown" else 1)
+        commands = commands[1:]
+
+    elif command == "mins-n-secs":
+
+        try:
+            secs = int(commands[0])
+        except:
+            log("seconds must be numeric", ERROR)
+            return None
+        as111.display_mins_n_secs(secs)
+        commands = commands[1:]
+
+    elif command == "date":
+
+        as111.display_date()
+
+    elif command == "display":
+
+        try:
+            secs = int(commands[0]) % 60
+            number = int(commands[1])
+        except:
+            log("seconds must be numeric", ERROR)
+            return None
+
+        as111.display_number(secs, number)
+        commands = commands[2:]
+
+    elif command == "list-codecs":
+
+        success, codecs = as111.get_supported_codecs()
+        if success:
+            print(json.dumps(codecs, indent=2))
+        else:
+            log("Codecs maybe not supported on your system?", ERROR)
+            return None
+
+    elif command == "switch-codec":
+
+        try:
+            success = as111.set_codec(commands[0])
+            if not success:
+                log("Switch to codec \"%s\" failed" % commands[0], ERROR)
+            commands = commands[1:]
+        except:
+            log("Codec must be given", ERROR)
+            return None
+
+    elif command == "listen":
+
+        secs = 0
+        if len(commands) > 0 and commands[0].isdigit():
+            secs = int(commands[0])
+            commands = commands[1:]
+
+        as111.listen(secs)
+
+    elif command == "capture":
+
+        filename = None
+        if len(commands) > 0 and commands[0].endswith(".cap"):
+            filename = commands[0]
+            commands = commands[1:]
+
+        as111.dump_capture(filename)
+
+    elif command == "profile":
+
+        # already evaluated on startup
+        if len(commands) > 0 and commands[0].endswith(".json"):
+            commands = commands[1:]
+
+    elif command == "info":
+
+        print_info(as111.get_current_device())
+
+    elif command == "json":
+
+        print_json(as111.get_current_device())
+
+    elif command == "debug":
+
+        loglevel = DEBUG
+
+    elif command == "verbose":
+
+        loglevel = INFO
+
+    return commands
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print_help()
+        exit(1)
+
+    if len(sys.argv) > 2 and sys.argv[2] in ["debug", "verbose"]:
+
+        loglevel = DEBUG if sys.argv[2] == "debug" else INFO
+
+    if "profile" in sys.argv[2:]:
+
+        i = sys.argv.index("profile", 2)
+        profiler.enable(sys.argv[i + 1] if len(sys.argv) > i + 1 and sys.argv[i + 1].endswith(".json") else None)
+
+    if sys.argv[1] == "replay":
+
+        if len(sys.argv) < 3:
+            log("capture file must be given", ERROR)
             exit(1)
 
-        elif alias:
-            log("Found alias \"%s\"" % alias, INFO)
+        try:
+            success = replay(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "")
+        except Exception as e:
+            log(str(e), ERROR)
+            exit(1)
 
-        addresses.append(address)
+        exit(0 if success else 1)
+
+    if sys.argv[1] == "emulate":
+
+        server = EmulatorServer(DockEmulator(), int(
+            sys.argv[2]) if len(sys.argv) > 2 else 0)
+        server.start()
+        print("emulated dock listens on %s" % server.get_address())
+
+        as111 = AS111(devices=[])
+        try:
+            while not as111.is_stop_signal():
+                time.sleep(1)
+        except:
+            pass
+
+        server.stop()
+        as111.clean_stop_signal()
+        exit(0)
+
+    if sys.argv[1] == "relay":
+
+        if len(sys.argv) < 5:
+            log("hosts, dock and command must be given", ERROR)
+            exit(1)
+
+        try:
+            relay = Relay(sys.argv[2].split(","))
+            results = relay.fan_out(sys.argv[3], sys.argv[4:])
+            relay.close()
+        except Exception as e:
+            log("relay failed: %s" % e, ERROR)
+            exit(1)
+
+        for host in sorted(results):
+            print(json.dumps(dict(results[host], host=host)))
+
+        exit(0 if all(r["ok"] for r in results.values()) else 1)
+
+    as111 = AS111(rescan=sys.argv[1] == "docks" and "rescan" in sys.argv[2:])
+    if sys.argv[1] == "stop":
+        log("Set stop signal", INFO)
+        as111.set_stop_signal()
+        exit(0)
+
+    elif sys.argv[1] == "docks":
+        print_docks(as111)
+        exit(0)
+
+    elif sys.argv[1] == "monitor":
+        as111.monitor_inventory()
+        as111.clean_stop_signal()
+        exit(0)
+
+    elif sys.argv[1] == "help":
+
+        print_help()
+        exit(0)
+
+    elif sys.argv[1] == "batch":
+        do_batch(as111, sys.stdin, sys.stdout)
+        exit(0)
+
+    elif sys.argv[1] == "mirror":
+
+        addresses = resolve_addresses(
+            as111, sys.argv[2] if len(sys.argv) > 2 else "--")
+        if addresses == None:
+            exit(1)
+
+        success = VolumeMirror(as111, addresses).run(as111.is_stop_signal)
+        as111.clean_stop_signal()
+        exit(0 if success else 1)
+
+    elif sys.argv[1] == "agent":
+
+        try:
+            agent = Agent(as111, int(sys.argv[2]) if len(
+                sys.argv) > 2 else Agent.PORT)
+        except Exception as e:
+            log("Unable to start agent: %s" % e, ERROR)
+            exit(1)
+
+        agent.serve(as111.is_stop_signal)
+        as111.clean_stop_signal()
+        exit(0)
+
+    elif sys.argv[1] == "telemetry":
+
+        try:
+            target = sys.argv[2]
+            interval = int(sys.argv[3])
+            if interval < 1:
+                raise ValueError()
+        except:
+            log("dock and interval must be given", ERROR)
+            exit(1)
+
+        fmt = sys.argv[4] if len(sys.argv) > 4 else "csv"
+        do_telemetry(as111, target, interval, fmt,
+                     sys.argv[5] if len(sys.argv) > 5 else None)
+        as111.clean_stop_signal()
+        exit(0)
+
+    addresses = resolve_addresses(as111, sys.argv[1])
+    if addresses == None:
+        exit(1)
 
-    commands = sys.argv[1:]
+    commands = sys.argv[2:]
     for address in addresses:
         success = do_commands(as111, address, commands)
         if not success:
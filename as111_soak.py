@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+#
+# MIT License
+#
+# Copyright (c) 2020 heckie75
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import as111
+
+_DEFAULTS = {
+    "docks": 50,
+    "rate": 100,
+    "duration": 60,
+    "interval": 10,
+    "workers": 16,
+    "reconnect": 0.1,
+    "delay": 0.0
+}
+
+_WORKLOAD = [
+    lambda: ["vol", str(random.randint(0, 32))],
+    lambda: ["vol", random.choice(["+1", "-1"])],
+    lambda: ["mute"],
+    lambda: ["alarm-led", random.choice(["on", "off"])],
+    lambda: ["sync"],
+    lambda: ["display", "0", str(random.randint(0, 9999))]
+]
+
+
+def get_rss():
+
+    try:
+        with open("/proc/self/status") as ins:
+            for line in ins:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except:
+        pass
+
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_fds():
+
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except:
+        return -1
+
+
+class Histogram():
+
+    # fixed buckets, so that memory does not grow during long runs.
+    # Buckets grow by 5 % from 10 us up to about 100 s
+    _BASE = 1e-5
+    _FACTOR = 1.05
+    _BUCKETS = 330
+
+    def __init__(self):
+
+        self.counts = [0] * self._BUCKETS
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+
+        i = 0 if value <= self._BASE else min(self._BUCKETS - 1, int(
+            math.log(value / self._BASE, self._FACTOR)) + 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+
+        if self.count == 0:
+            return 0.0
+
+        # upper bound of the bucket that contains the requested rank
+        rank = min(self.count - 1, int(self.count * p / 100))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen > rank:
+                return min(self.max, self._BASE * self._FACTOR ** i)
+
+        return self.max
+
+
+class Stats():
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.ops = 0
+        self.errors = 0
+        self._latencies = Histogram()
+
+    def add(self, latency, success):
+
+        with self._lock:
+            self.ops += 1
+            self._latencies.add(latency)
+            if not success:
+                self.errors += 1
+
+    def take(self):
+
+        with self._lock:
+            latencies = self._latencies
+            self._latencies = Histogram()
+
+        return latencies
+
+
+def soak(settings):
+
+    # measured before anything is set up, so that a clean shutdown shows 0
+    rss_start = get_rss()
+    fds_start = get_fds()
+
+    servers = list()
+    devices = list()
+    for i in range(settings["docks"]):
+        server = as111.EmulatorServer(
+            as111.DockEmulator(), delay=settings["delay"])
+        server.start()
+        servers.append(server)
+
+        address = server.get_address()
+        devices.append(as111.AS111._new_device(
+            "TCP", address, "00:1D:DF:00:%02X:%02X" % (i // 256, i % 256), "", "emulated #%i" % i, True))
+
+    control = as111.AS111(devices=devices)
+    pool = as111.ConnectionPool(control)
+    addresses = [d["address"] for d in devices]
+
+    stats = Stats()
+    jobs = queue.Queue()
+    devnull = open(os.devnull, "w")
+
+    def worker():
+
+        while True:
+            job = jobs.get()
+            if job == None:
+                return
+
+            due, address, commands, reconnect = job
+            success = False
+            try:
+                with pool.lock(address):
+                    if reconnect:
+                        # full path of a single invocation
+                        pool.close(address)
+                        success = as111.do_commands(
+                            control.session(address), address, commands)
+
+                    else:
+                        connection = pool.get(address)
+                        success = connection != None and as111.process_commands(
+                            connection, commands) and not connection.is_link_failed()
+            except:
+                pass
+
+            # latency counts from the planned start, so queueing is included
+            stats.add(time.time() - due, success)
+
+    sys.stdout = devnull
+    workers = [threading.Thread(target=worker, daemon=True)
+               for i in range(settings["workers"])]
+    for w in workers:
+        w.start()
+
+    started = time.time()
+    next_report = started + settings["interval"]
+    period = 1.0 / settings["rate"]
+    due = started
+    latencies = Histogram()
+
+    report("    time      ops    ops/s   p50 ms   p95 ms   p99 ms errors  rss kB   fds  queue")
+    try:
+        while due < started + settings["duration"]:
+
+            now = time.time()
+            if due > now:
+                time.sleep(max(0, min(due, next_report) - now))
+
+            if time.time() >= next_report:
+                _latencies = stats.take()
+                latencies.merge(_latencies)
+                report("%8.1f %8i %8.1f %8.1f %8.1f %8.1f %6i %7i %5i %6i" % (
+                    time.time() - started, stats.ops,
+                    _latencies.count / settings["interval"],
+                    _latencies.percentile(50) * 1000,
+                    _latencies.percentile(95) * 1000,
+                    _latencies.percentile(99) * 1000,
+                    stats.errors, get_rss(), get_fds(), jobs.qsize()))
+                next_report += settings["interval"]
+
+            while due <= time.time():
+                jobs.put((due, random.choice(addresses), random.choice(_WORKLOAD)(),
+                          random.random() < settings["reconnect"]))
+                due += period
+
+    except KeyboardInterrupt:
+        report("interrupted")
+
+    for w in workers:
+        jobs.put(None)
+    for w in workers:
+        w.join()
+
+    pool.close_all()
+    for server in servers:
+        server.stop()
+
+    sys.stdout = sys.__stdout__
+    devnull.close()
+
+    latencies.merge(stats.take())
+    elapsed = time.time() - started
+    report("""
+Docks:       %i
+Operations:  %i in %.1f s (%.1f ops/s)
+Errors:      %i (%.2f %%)
+Latency:     p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms
+RSS growth:  %i kB
+FD growth:   %i
+""" % (settings["docks"],
+       stats.ops, elapsed, stats.ops / elapsed,
+       stats.errors, 100.0 * stats.errors / max(1, stats.ops),
+       latencies.percentile(50) * 1000,
+       latencies.percentile(95) * 1000,
+       latencies.percentile(99) * 1000,
+       latencies.max * 1000,
+       get_rss() - rss_start, get_fds() - fds_start))
+
+    return stats.errors == 0
+
+
+def report(s):
+
+    sys.__stdout__.write(s + "\n")
+    sys.__stdout__.flush()
+
+
+def print_help():
+
+    print("""
+ USAGE:   as111_soak.py [setting value] ...
+ EXAMPLE: 50 emulated docks, 200 commands per second for one hour
+          $ ./as111_soak.py docks 50 rate 200 duration 3600
+
+ docks <n>               Number of emulated docks, default %(docks)i
+ rate <n>                Commands per second, default %(rate)i
+ duration <secs>         Duration of test in seconds, default %(duration)i
+ interval <secs>         Report interval in seconds, default %(interval)i
+ workers <n>             Number of threads that send commands, default %(workers)i
+ reconnect <0-1>         Share of commands that run through do_commands() with
+                         a new connection instead of pooled ones, default %(reconnect).1f
+ delay <secs>            Delay of emulated docks per response, default %(delay).1f
+    """ % _DEFAULTS)
+
+
+if __name__ == "__main__":
+
+    settings = dict(_DEFAULTS)
+    args = sys.argv[1:]
+    try:
+        while len(args) > 0:
+            if args[0] not in settings:
+                raise ValueError(args[0])
+
+            settings[args[0]] = type(settings[args[0]])(args[1])
+            args = args[2:]
+
+    except:
+        print_help()
+        exit(1)
+
+    exit(0 if soak(settings) else 1)